@@ -1,10 +1,13 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Set
 import json
+import copy
 import random
 import asyncio
+import tempfile
+import time
 from datetime import datetime
 from openai import OpenAI
 import os
@@ -38,6 +41,14 @@ SKILLS = [
     "挑球", "放网", "扑球", "勾球", "搓球"
 ]
 
+# 房间快照配置
+ROOMS_DIR = "data/rooms"
+SNAPSHOT_INTERVAL = float(os.getenv("ROOM_SNAPSHOT_INTERVAL", "5"))  # 秒
+SNAPSHOT_TTL = float(os.getenv("ROOM_SNAPSHOT_TTL", "86400"))  # 超过此时长未更新的快照在启动时删除（秒）
+SEAT_TIMEOUT = float(os.getenv("ROOM_SEAT_TIMEOUT", "300"))  # 服务启动后为原玩家保留座位的时长（秒）
+SERVER_STARTED_AT = time.monotonic()  # 保留座位从服务启动时开始计时
+SERVICE_RESTART_CODE = 1012  # 服务端关闭时uvicorn给连接的关闭码
+
 # 游戏房间管理
 class GameRoom:
     def __init__(self, room_id: str, mode: str):
@@ -46,6 +57,7 @@ class GameRoom:
         self.players: Dict[str, dict] = {}  # 参赛玩家
         self.spectators: Dict[str, dict] = {}  # 观众
         self.websockets: Dict[str, WebSocket] = {}  # 所有连接（包括观众）
+        self.reserved_seats: Set[str] = set()  # 从快照恢复、尚未重连的玩家
         self.game_state = {
             "status": "waiting",  # waiting, playing, finished
             "current_server": None,
@@ -62,6 +74,42 @@ class GameRoom:
             "team_a": [],  # 队伍A的玩家
             "team_b": []  # 队伍B的玩家
         }
+        self.version = 0  # 每次状态变更递增
+        self.saved_version = 0  # 最近一次写入快照时的版本
+    
+    def mark_dirty(self):
+        """标记房间状态已变更，等待下次快照写入"""
+        self.version += 1
+    
+    def snapshot(self) -> Optional[dict]:
+        """
+        在事件循环内复制一份房间状态，之后的写盘只读这份副本
+        :return: 快照；已结束或没有玩家的房间返回None（删除快照文件）
+        """
+        roster = list(self.players) + list(self.reserved_seats)
+        if not roster or self.game_state["status"] == "finished":
+            return None
+        return {
+            "room_id": self.room_id,
+            "mode": self.mode,
+            "players": roster,  # 只保存玩家名单，观众不保存
+            "game_state": copy.deepcopy(self.game_state),
+            "saved_at": datetime.now().isoformat()
+        }
+    
+    @classmethod
+    def from_snapshot(cls, data: dict) -> "GameRoom":
+        """从快照恢复房间，原玩家以保留座位的形式等待重连"""
+        room = cls(data["room_id"], data["mode"])
+        room.reserved_seats = set(data.get("players", []))
+        room.game_state.update(data.get("game_state", {}))
+        return room
+    
+    def release_expired_seats(self):
+        """服务启动超过保留时长后，释放所有未重连的保留座位"""
+        if self.reserved_seats and time.monotonic() - SERVER_STARTED_AT >= SEAT_TIMEOUT:
+            self.reserved_seats.clear()
+            self.mark_dirty()
     
     def get_player_team(self, username: str) -> str:
         """获取玩家所属队伍"""
@@ -72,6 +120,8 @@ class GameRoom:
         return None
 
 rooms: Dict[str, GameRoom] = {}
+saved_room_ids: Set[str] = set()  # 磁盘上有快照但尚未加载的房间
+room_loads: Dict[str, asyncio.Task] = {}  # 正在从快照加载的房间
 
 # 数据模型
 class PlayerProfile(BaseModel):
@@ -105,6 +155,117 @@ def save_player_profile(username: str, skills: Dict[str, int]):
             "updated_at": datetime.now().isoformat()
         }, f, ensure_ascii=False, indent=2)
 
+# 房间快照管理
+def remove_room_snapshot(room_id: str):
+    """删除房间快照文件"""
+    try:
+        os.remove(f"{ROOMS_DIR}/{room_id}.json")
+    except FileNotFoundError:
+        pass
+
+def write_room_snapshots(snapshots: Dict[str, Optional[dict]]):
+    """
+    把房间快照写入文件（在线程池中执行，先写临时文件再原子替换）
+    :param snapshots: 房间ID: 快照，快照为None时删除该房间的文件
+    """
+    os.makedirs(ROOMS_DIR, exist_ok=True)
+    for room_id, data in snapshots.items():
+        if data is None:
+            remove_room_snapshot(room_id)
+            continue
+        with tempfile.NamedTemporaryFile(
+            'w', encoding='utf-8', dir=ROOMS_DIR, suffix=".tmp", delete=False
+        ) as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(f.name, f"{ROOMS_DIR}/{room_id}.json")
+
+async def snapshot_dirty_rooms():
+    """增量写入有变更的房间，写盘不阻塞事件循环"""
+    for room in rooms.values():
+        room.release_expired_seats()
+    pending = [
+        (room, room.version, room.snapshot())
+        for room in rooms.values()
+        if room.version != room.saved_version
+    ]
+    if not pending:
+        return
+    await asyncio.to_thread(
+        write_room_snapshots, {room.room_id: data for room, _, data in pending}
+    )
+    for room, version, _ in pending:
+        room.saved_version = version
+
+async def snapshot_rooms_periodically(stop: asyncio.Event):
+    """定期保存房间快照，收到停止信号后再保存最后一次并退出"""
+    while True:
+        try:
+            await asyncio.wait_for(stop.wait(), SNAPSHOT_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        try:
+            await snapshot_dirty_rooms()
+        except Exception as e:
+            print(f"房间快照保存失败: {e}")
+        if stop.is_set():
+            return
+
+def load_room_snapshot(room_id: str) -> Optional[GameRoom]:
+    """从文件加载房间快照"""
+    filename = f"{ROOMS_DIR}/{room_id}.json"
+    try:
+        with open(filename, 'r', encoding='utf-8') as f:
+            return GameRoom.from_snapshot(json.load(f))
+    except (OSError, ValueError, KeyError) as e:
+        print(f"房间快照加载失败 {room_id}: {e}")
+        return None
+
+async def restore_room(room_id: str) -> Optional[GameRoom]:
+    """在线程池中读取快照并登记恢复的房间"""
+    try:
+        room = await asyncio.to_thread(load_room_snapshot, room_id)
+        if room:
+            rooms[room_id] = room
+        return room
+    finally:
+        saved_room_ids.discard(room_id)
+        room_loads.pop(room_id, None)
+
+async def get_room(room_id: str) -> Optional[GameRoom]:
+    """获取房间，首次访问时才从快照恢复；同一房间的并发访问共用一次加载"""
+    room = rooms.get(room_id)
+    if room is not None or room_id not in saved_room_ids:
+        return room
+    load = room_loads.get(room_id)
+    if load is None:
+        load = room_loads[room_id] = asyncio.create_task(restore_room(room_id))
+    return await asyncio.shield(load)
+
+@app.on_event("startup")
+async def start_room_snapshots():
+    """启动时只登记已有快照的房间ID，不解析文件内容；过期快照和残留临时文件直接删除"""
+    if os.path.isdir(ROOMS_DIR):
+        now = time.time()
+        with os.scandir(ROOMS_DIR) as entries:
+            for entry in entries:
+                if entry.name.endswith(".json") and now - entry.stat().st_mtime < SNAPSHOT_TTL:
+                    saved_room_ids.add(entry.name[:-len(".json")])
+                    continue
+                try:
+                    os.remove(entry.path)
+                except OSError as e:
+                    print(f"过期房间快照删除失败 {entry.name}: {e}")
+    app.state.snapshot_stop = asyncio.Event()
+    app.state.snapshot_task = asyncio.create_task(
+        snapshot_rooms_periodically(app.state.snapshot_stop)
+    )
+
+@app.on_event("shutdown")
+async def flush_room_snapshots():
+    """关闭前等待快照任务写完最后一次变更"""
+    app.state.snapshot_stop.set()
+    await app.state.snapshot_task
+
 # API端点
 @app.post("/api/player/save")
 async def save_player(profile: PlayerProfile):
@@ -134,7 +295,7 @@ async def create_room(request: CreateRoomRequest):
     # 生成简短的房间ID（6位随机数字）
     room_id = str(random.randint(100000, 999999))
     # 如果房间ID已存在，重新生成
-    while room_id in rooms:
+    while room_id in rooms or room_id in saved_room_ids:
         room_id = str(random.randint(100000, 999999))
     rooms[room_id] = GameRoom(room_id, request.mode)
     return {"room_id": room_id, "mode": request.mode}
@@ -345,13 +506,12 @@ async def generate_ai_description(skill: str, result: dict, game_state: dict, pl
 async def websocket_endpoint(websocket: WebSocket, room_id: str, username: str):
     await websocket.accept()
     
-    if room_id not in rooms:
+    room = await get_room(room_id)
+    if room is None:
         await websocket.send_json({"type": "error", "message": "房间不存在"})
         await websocket.close()
         return
     
-    room = rooms[room_id]
-    
     # 加载玩家配置
     player_profile = load_player_profile(username)
     if not player_profile:
@@ -363,7 +523,24 @@ async def websocket_endpoint(websocket: WebSocket, room_id: str, username: str):
     is_spectator = False
     max_players = 2 if room.mode == "2p" else 4
     
-    if room.game_state["status"] == "playing":
+    # 服务重启前就在房间内的玩家，在保留时间内重连可回到原位置
+    room.release_expired_seats()
+    
+    if username in room.reserved_seats:
+        room.reserved_seats.discard(username)
+        room.players[username] = player_profile
+        room.websockets[username] = websocket
+        room.mark_dirty()
+        
+        await broadcast_to_room(room, {
+            "type": "player_joined",
+            "username": username,
+            "players": list(room.players.keys()),
+            "spectators": list(room.spectators.keys()),
+            "player_count": len(room.players),
+            "game_state": room.game_state  # 重连玩家需要恢复的比赛状态
+        })
+    elif room.game_state["status"] == "playing":
         # 游戏已开始，加入观众席
         is_spectator = True
         room.spectators[username] = player_profile
@@ -375,8 +552,8 @@ async def websocket_endpoint(websocket: WebSocket, room_id: str, username: str):
             "players": list(room.players.keys()),
             "spectators": list(room.spectators.keys())
         })
-    elif len(room.players) >= max_players:
-        # 房间已满，加入观众席
+    elif len(room.players) + len(room.reserved_seats) >= max_players:
+        # 房间已满（含保留座位），加入观众席
         is_spectator = True
         room.spectators[username] = player_profile
         room.websockets[username] = websocket
@@ -391,6 +568,7 @@ async def websocket_endpoint(websocket: WebSocket, room_id: str, username: str):
         # 加入为玩家
         room.players[username] = player_profile
         room.websockets[username] = websocket
+        room.mark_dirty()
         
         await broadcast_to_room(room, {
             "type": "player_joined",
@@ -404,14 +582,20 @@ async def websocket_endpoint(websocket: WebSocket, room_id: str, username: str):
         while True:
             data = await websocket.receive_json()
             await handle_game_action(room, username, data, is_spectator)
-    except WebSocketDisconnect:
+    except WebSocketDisconnect as e:
+        if username in room.websockets:
+            del room.websockets[username]
+        
+        # 服务关闭导致的断开不算离开房间，保留玩家名单供快照写入
+        if e.code == SERVICE_RESTART_CODE:
+            return
+        
         # 移除玩家或观众
         if username in room.players:
             del room.players[username]
+            room.mark_dirty()
         if username in room.spectators:
             del room.spectators[username]
-        if username in room.websockets:
-            del room.websockets[username]
             
         await broadcast_to_room(room, {
             "type": "player_left" if not is_spectator else "spectator_left",
@@ -454,6 +638,15 @@ async def handle_game_action(room: GameRoom, username: str, data: dict, is_spect
         return
     
     if action_type == "start_game" or action_type == "restart_game":
+        # 原玩家尚未重连时不能开始，否则他们会被排除在队伍之外
+        room.release_expired_seats()
+        if room.reserved_seats:
+            await room.websockets[username].send_json({
+                "type": "error",
+                "message": f"等待原玩家重连：{', '.join(sorted(room.reserved_seats))}"
+            })
+            return
+        
         # 开始游戏或重新开始
         player_list = list(room.players.keys())
         
@@ -486,6 +679,7 @@ async def handle_game_action(room: GameRoom, username: str, data: dict, is_spect
         room.game_state["rally_count"] = 0
         room.game_state["rally_history"] = []
         room.game_state["last_player"] = None
+        room.mark_dirty()
         
         await broadcast_to_room(room, {
             "type": "game_started" if action_type == "start_game" else "game_restarted",
@@ -657,6 +851,7 @@ async def handle_game_action(room: GameRoom, username: str, data: dict, is_spect
                 room.game_state["status"] = "finished"
                 shot_info["game_over"] = True
         
+        room.mark_dirty()
         await broadcast_to_room(room, shot_info)
 
 if __name__ == "__main__":
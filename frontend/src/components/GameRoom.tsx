@@ -134,6 +134,10 @@ function GameRoom({ playerProfile, roomId, gameMode, onLeave }: Props) {
       case 'player_joined':
         setPlayers(data.players)
         setSpectators(data.spectators || [])
+        // 服务重启后重连的玩家会带上恢复的比赛状态
+        if (data.game_state) {
+          setGameState(data.game_state)
+        }
         addLog({ type: 'system', message: `${data.username} 加入了房间`, timestamp: Date.now() })
         break
 